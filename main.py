@@ -1,15 +1,29 @@
 # main.py
-import json
+import asyncio
+import base64
+import functools
 import logging
 import os
+import random
+import re
+import shutil
 import tempfile
-import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
 
+import av
 import cv2
-from fastapi import FastAPI, Request
+import google_crc32c
+import httpx
+import orjson
+from fastapi import BackgroundTasks, FastAPI, Request
+from fastapi.responses import JSONResponse
 from google.cloud import storage
+from google.cloud.storage.retry import DEFAULT_RETRY
 from google import genai
-from google.genai import types
+from google.genai import errors, types
 
 # Configure logging
 logging.basicConfig(
@@ -18,21 +32,166 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Matches the {"second": <number>} object in Gemini's response text
+SECOND_JSON_RE = re.compile(r'\{[^{}]*"second"\s*:\s*"?[-\d.eE]+"?[^{}]*\}')
+
 app = FastAPI()
-storage_client = storage.Client()
 
 OUTPUT_BUCKET = os.environ.get("OUTPUT_BUCKET")
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 
-# Initialize Gemini client
-if GEMINI_API_KEY:
-    os.environ["GEMINI_API_KEY"] = GEMINI_API_KEY
-    genai_client = genai.Client()
-    logger.info("Gemini client initialized")
-else:
-    genai_client = None
+# Let Gemini read videos straight from GCS instead of uploading them
+# (requires the bucket to be readable by the Gemini project)
+GEMINI_USE_GCS_URI = os.environ.get("GEMINI_USE_GCS_URI", "false").lower() == "true"
+
+# HTTP transport settings for the Gemini client (timeout in milliseconds)
+GEMINI_HTTP_TIMEOUT_MS = 300_000
+GEMINI_MAX_KEEPALIVE_CONNECTIONS = 16
+GEMINI_KEEPALIVE_EXPIRY = 120
+
+# Concurrency gate and 429 retry settings for Gemini calls.
+# MAX_CONCURRENT_GEMINI is the budget per instance; each gunicorn worker has
+# its own semaphore, so the budget is split across WEB_CONCURRENCY workers.
+MAX_CONCURRENT_GEMINI = int(os.environ.get("MAX_CONCURRENT_GEMINI", "4"))
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", "1"))
+MAX_CONCURRENT_GEMINI_PER_WORKER = max(1, MAX_CONCURRENT_GEMINI // WEB_CONCURRENCY)
+GEMINI_MAX_ATTEMPTS = 3
+GEMINI_BASE_BACKOFF = 1.0
+GEMINI_JITTER_FACTOR = 0.25
+
+# Backoff settings for polling the Gemini file state until it becomes ACTIVE
+FILE_POLL_INITIAL_DELAY = 0.25
+FILE_POLL_MAX_DELAY = 2.0
+FILE_POLL_BACKOFF = 1.6
+FILE_POLL_TIMEOUT = 120.0
+
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+DOWNLOAD_MAX_WORKERS = 8
+# Videos up to this size are kept in memory instead of on local disk.
+# Each request may hold two spools (input and transcoded copy).
+VIDEO_SPOOL_MAX_SIZE = 64 * 1024 * 1024
+# Read size for ranged GETs when extracting a frame straight from GCS
+RANGE_READ_CHUNK_SIZE = 1024 * 1024
+# How far before the target the OpenCV fallback seeks before grabbing forward
+OPENCV_SEEK_LEAD_MS = 2000
+# Number of GCS-backed PyAV containers kept open for repeated videos
+CONTAINER_CACHE_SIZE = 4
+
+# Videos shorter than this (seconds) are sent to Gemini as sampled frames
+# instead of uploading the whole video
+SAMPLED_FRAMES_MAX_DURATION = float(os.environ.get("SAMPLED_FRAMES_MAX_DURATION", "60"))
+SAMPLED_FRAMES_FPS = 1
+SAMPLED_FRAME_MAX_WIDTH = 768
+SAMPLED_FRAME_JPEG_QUALITY = 75
+
+# Longer videos are downscaled before being uploaded to Gemini, since input
+# tokens scale with frames x resolution
+TRANSCODE_FOR_GEMINI = os.environ.get("TRANSCODE_FOR_GEMINI", "true").lower() == "true"
+TRANSCODE_FPS = 5
+TRANSCODE_MAX_HEIGHT = 480
+
+# Check the extracted frame for hands before saving it, to skip uploads
+# when Gemini returns a timestamp without the gesture
+VERIFY_HANDS = os.environ.get("VERIFY_HANDS", "true").lower() == "true"
+
+FRAME_FORMAT = os.environ.get("FRAME_FORMAT", "jpg").lower()
+
+# Encoder settings per output frame format: (extension, content type, imencode params)
+FRAME_ENCODINGS = {
+    "jpg": (".jpg", "image/jpeg", [cv2.IMWRITE_JPEG_QUALITY, 90, cv2.IMWRITE_JPEG_OPTIMIZE, 1]),
+    "webp": (".webp", "image/webp", [cv2.IMWRITE_WEBP_QUALITY, 90]),
+    "png": (".png", "image/png", []),
+}
+if FRAME_FORMAT not in FRAME_ENCODINGS:
+    logger.warning(f"Unsupported FRAME_FORMAT '{FRAME_FORMAT}', falling back to jpg")
+    FRAME_FORMAT = "jpg"
+
+if not GEMINI_API_KEY:
     logger.warning("GEMINI_API_KEY not configured - video analysis will be disabled")
 
+gemini_semaphore = asyncio.Semaphore(MAX_CONCURRENT_GEMINI_PER_WORKER)
+
+# LRU of open PyAV containers keyed by (bucket, name, generation).
+# Each entry is (container, reader, lock); the lock serializes decoding.
+container_cache = OrderedDict()
+container_cache_lock = threading.Lock()
+
+# MediaPipe Hands graphs are not thread-safe, so calls are serialized
+hands_lock = threading.Lock()
+
+
+# Clients are created lazily in the worker process (and warmed at startup),
+# so import stays cheap and no gRPC/HTTP connections are inherited across a
+# gunicorn fork
+@functools.lru_cache(maxsize=1)
+def get_storage_client():
+    """Returns the shared Cloud Storage client."""
+    return storage.Client()
+
+
+@functools.lru_cache(maxsize=1)
+def get_genai_client():
+    """Returns the shared Gemini client, or None if GEMINI_API_KEY is not set."""
+    if not GEMINI_API_KEY:
+        return None
+    client = genai.Client(
+        http_options=types.HttpOptions(
+            timeout=GEMINI_HTTP_TIMEOUT_MS,
+            client_args={
+                "limits": httpx.Limits(
+                    max_keepalive_connections=GEMINI_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=GEMINI_KEEPALIVE_EXPIRY,
+                ),
+            },
+        )
+    )
+    logger.info("Gemini client initialized")
+    return client
+
+
+@functools.lru_cache(maxsize=1)
+def get_hands_detector():
+    """
+    Returns the shared MediaPipe Hands detector for single images.
+    Raises if MediaPipe cannot be loaded, since VERIFY_HANDS asked for it.
+    """
+    try:
+        import mediapipe as mp
+        detector = mp.solutions.hands.Hands(static_image_mode=True, max_num_hands=2)
+    except Exception as e:
+        logger.error(f"Could not load MediaPipe Hands (set VERIFY_HANDS=false to skip the hands check): {str(e)}")
+        raise
+    logger.info("MediaPipe Hands detector loaded")
+    return detector
+
+
+def warm_up_genai_client():
+    """Creates the Gemini client and opens its connection pool."""
+    genai_client = get_genai_client()
+    if not genai_client:
+        return
+    try:
+        # Fetching one page forces auth, DNS and TLS setup on the pooled client
+        genai_client.models.list(config={"page_size": 1})
+        logger.info("Gemini client warmed up")
+    except Exception as e:
+        logger.warning(f"Gemini warm-up failed: {str(e)}")
+
+
+@app.on_event("startup")
+async def init_clients():
+    """
+    Initializes the storage and Gemini clients (and the hands detector, if
+    enabled) in parallel before the first event arrives.
+    """
+    startup_tasks = [
+        asyncio.to_thread(get_storage_client),
+        asyncio.to_thread(warm_up_genai_client),
+    ]
+    if VERIFY_HANDS:
+        startup_tasks.append(asyncio.to_thread(get_hands_detector))
+    await asyncio.gather(*startup_tasks)
+
 
 @app.get("/health")
 async def health():
@@ -41,13 +200,14 @@ async def health():
 
 
 @app.post("/")
-async def handle_event(request: Request):
+async def handle_event(request: Request, background_tasks: BackgroundTasks):
     """
     Entry point for Eventarc -> Cloud Run.
     Downloads video from GCS and uses Gemini Vision to detect when kid saying "67" appears.
     """
     request_body = await request.json()
-    logger.info(f"Received event: {json.dumps(request_body, indent=2)}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Received event: %s", orjson.dumps(request_body).decode())
     
     # Extract bucket and object name from the request
     bucket_name = request_body.get("bucket")
@@ -60,9 +220,8 @@ async def handle_event(request: Request):
             bucket_name = data.get("bucket") or bucket_name
             object_name = data.get("name") or object_name
         elif isinstance(data, str):
-            import base64
             try:
-                decoded_data = json.loads(base64.b64decode(data).decode('utf-8'))
+                decoded_data = orjson.loads(base64.b64decode(data))
                 bucket_name = decoded_data.get("bucket") or bucket_name
                 object_name = decoded_data.get("name") or object_name
             except Exception as e:
@@ -70,49 +229,52 @@ async def handle_event(request: Request):
     
     if not bucket_name or not object_name:
         logger.error("Missing bucket or name in request")
-        return {"status": "error", "message": "missing bucket or name"}, 400
+        return JSONResponse({"status": "error", "message": "missing bucket or name"}, status_code=400)
     
     if not GEMINI_API_KEY:
         logger.error("GEMINI_API_KEY not configured")
-        return {"status": "error", "message": "GEMINI_API_KEY not configured"}, 500
+        return JSONResponse({"status": "error", "message": "GEMINI_API_KEY not configured"}, status_code=500)
     
     logger.info(f"Processing video: gs://{bucket_name}/{object_name}")
     
-    # Download video to a temp file
-    tmp_video = tempfile.NamedTemporaryFile(suffix=".mp4", delete=False)
-    tmp_video_name = tmp_video.name
-    tmp_video.close()
+    # Spooled temp file for the local copy; it stays in memory for
+    # small videos and is removed automatically when closed
+    video = tempfile.SpooledTemporaryFile(max_size=VIDEO_SPOOL_MAX_SIZE)
     
     try:
-        bucket = storage_client.bucket(bucket_name)
+        bucket = get_storage_client().bucket(bucket_name)
         blob = bucket.blob(object_name)
-        blob.download_to_filename(tmp_video_name)
-        logger.info(f"Downloaded video to {tmp_video_name}")
         
         # Process video with Gemini to detect kid saying "67"
-        kid_detected, target_second, kid_frame = detect_kid_saying_67_with_gemini(tmp_video_name)
+        kid_detected, target_second, kid_frame = await detect_kid_saying_67_with_gemini(blob, video)
         
         if kid_detected:
             logger.info(f"Kid saying '67' detected at {target_second} seconds")
             
             frame_name = None
             if OUTPUT_BUCKET and kid_frame is not None:
-                frame_name = f"{os.path.splitext(object_name)[0]}-kid-67-frame-{target_second:.1f}s.png"
-                out_bucket = storage_client.bucket(OUTPUT_BUCKET)
+                extension, content_type, encode_params = FRAME_ENCODINGS[FRAME_FORMAT]
+                frame_name = f"{os.path.splitext(object_name)[0]}-kid-67-frame-{target_second:.1f}s{extension}"
+                out_bucket = get_storage_client().bucket(OUTPUT_BUCKET)
                 out_blob = out_bucket.blob(frame_name)
                 
-                success, buf = cv2.imencode(".png", kid_frame)
+                success, buf = cv2.imencode(extension, kid_frame, encode_params)
                 if success:
-                    out_blob.upload_from_string(buf.tobytes(), content_type="image/png")
-                    logger.info(f"Uploaded frame to gs://{OUTPUT_BUCKET}/{frame_name}")
+                    # The response does not wait for the frame to be persisted,
+                    # so it only reports that the upload was scheduled.
+                    # upload_from_string only accepts bytes (not memoryview), and
+                    # wraps them in a BytesIO without copying again, so tobytes()
+                    # is the only copy of the encoded image.
+                    background_tasks.add_task(upload_frame, out_blob, buf.tobytes(), content_type)
                 else:
-                    logger.error("Failed to encode frame as PNG")
+                    logger.error(f"Failed to encode frame as {FRAME_FORMAT.upper()}")
+                    frame_name = None
             
             return {
                 "status": "ok",
                 "kid_detected": True,
                 "timestamp_seconds": target_second,
-                "frame_saved": OUTPUT_BUCKET is not None and frame_name is not None,
+                "frame_upload_scheduled": OUTPUT_BUCKET is not None and frame_name is not None,
                 "frame_name": frame_name
             }
         else:
@@ -125,20 +287,281 @@ async def handle_event(request: Request):
     
     except Exception as e:
         logger.error(f"Error processing video: {str(e)}", exc_info=True)
-        return {"status": "error", "message": str(e)}, 500
+        status_code = 429 if is_rate_limited(e) else 500
+        return JSONResponse({"status": "error", "message": str(e)}, status_code=status_code)
     
     finally:
-        # Clean up temp file
-        if os.path.exists(tmp_video_name):
-            os.unlink(tmp_video_name)
+        video.close()
+
+
+def upload_frame(out_blob, data: bytes, content_type: str):
+    """
+    Uploads an encoded frame to the output bucket, retrying transient errors.
+    Runs as a background task after the response is sent, so failures are
+    only logged.
+    """
+    try:
+        out_blob.upload_from_string(data, content_type=content_type, retry=DEFAULT_RETRY)
+        logger.info(f"Uploaded frame to gs://{out_blob.bucket.name}/{out_blob.name}")
+    except Exception as e:
+        logger.error(f"Failed to upload frame {out_blob.name}: {str(e)}", exc_info=True)
+
+
+def download_blob(blob, video):
+    """
+    Downloads a blob into the spooled file video and rewinds it.
+    Larger blobs are fetched as concurrent ranged chunks to avoid being
+    bound by a single HTTP stream; small blobs use a plain download.
+    """
+    blob.reload()
+    if blob.size is not None and blob.size > VIDEO_SPOOL_MAX_SIZE:
+        video.rollover()
+    
+    if blob.size is None or blob.size <= DOWNLOAD_CHUNK_SIZE:
+        blob.download_to_file(video)
+    else:
+        write_lock = threading.Lock()
+        
+        def download_chunk(start):
+            end = min(start + DOWNLOAD_CHUNK_SIZE, blob.size) - 1
+            data = blob.download_as_bytes(start=start, end=end, checksum=None)
+            with write_lock:
+                video.seek(start)
+                video.write(data)
+        
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_MAX_WORKERS) as executor:
+            list(executor.map(download_chunk, range(0, blob.size, DOWNLOAD_CHUNK_SIZE)))
+        
+        # Ranged reads cannot be checksummed individually, so validate the
+        # assembled object against its CRC32C like download_to_file does
+        if blob.crc32c is not None:
+            video.seek(0)
+            checksum = google_crc32c.Checksum()
+            for data in iter(lambda: video.read(DOWNLOAD_CHUNK_SIZE), b""):
+                checksum.update(data)
+            actual = base64.b64encode(checksum.digest()).decode("ascii")
+            if actual != blob.crc32c:
+                raise ValueError(
+                    f"Checksum mismatch downloading {blob.name}: "
+                    f"expected crc32c {blob.crc32c}, got {actual}"
+                )
+    video.seek(0)
+
+
+def is_rate_limited(error: Exception) -> bool:
+    """Returns True if the error is a Gemini quota (429) error."""
+    if isinstance(error, errors.APIError) and error.code == 429:
+        return True
+    return "RESOURCE_EXHAUSTED" in str(error)
+
+
+def get_retry_delay(error: Exception):
+    """Returns the server-suggested retry delay in seconds, if the error has one."""
+    details = getattr(error, "details", None)
+    if isinstance(details, dict):
+        body = details.get("error", details)
+        details = body.get("details") if isinstance(body, dict) else None
+    if not isinstance(details, list):
+        return None
+    for detail in details:
+        if isinstance(detail, dict) and "retryDelay" in detail:
+            match = re.match(r"([\d.]+)s", str(detail["retryDelay"]))
+            if match:
+                return float(match.group(1))
+    return None
+
+
+async def call_gemini(func, *args, **kwargs):
+    """
+    Runs a blocking Gemini SDK call in a worker thread, limited to
+    MAX_CONCURRENT_GEMINI_PER_WORKER concurrent calls in this process.
+    Retries rate-limited calls with exponential backoff and jitter.
+    """
+    for attempt in range(1, GEMINI_MAX_ATTEMPTS + 1):
+        try:
+            async with gemini_semaphore:
+                return await asyncio.to_thread(func, *args, **kwargs)
+        except Exception as e:
+            if not is_rate_limited(e) or attempt == GEMINI_MAX_ATTEMPTS:
+                raise
+            delay = get_retry_delay(e) or GEMINI_BASE_BACKOFF * 2 ** (attempt - 1)
+            delay *= 1 + random.uniform(-GEMINI_JITTER_FACTOR, GEMINI_JITTER_FACTOR)
+            logger.warning(
+                f"gemini.rate_limited: attempt {attempt}/{GEMINI_MAX_ATTEMPTS}, "
+                f"retrying in {delay:.2f}s"
+            )
+            await asyncio.sleep(delay)
+
+
+async def download_and_upload_video(blob, video):
+    """
+    Downloads the video locally (for frame extraction) while streaming it
+    from GCS to Gemini, so the two network transfers overlap.
+    Returns the uploaded Gemini file.
+    """
+    download_result, upload_result = await asyncio.gather(
+        asyncio.to_thread(download_blob, blob, video),
+        call_gemini(upload_video_to_gemini, blob),
+        return_exceptions=True,
+    )
+    if isinstance(download_result, Exception):
+        if not isinstance(upload_result, Exception):
+            delete_gemini_file(upload_result)
+        raise download_result
+    if isinstance(upload_result, Exception):
+        raise upload_result
+    logger.info(f"Downloaded video {blob.name}")
+    return upload_result
+
+
+def upload_video_to_gemini(blob):
+    """
+    Streams a video blob from GCS straight into the Gemini file store.
+    Returns the uploaded Gemini file.
+    """
+    with blob.open("rb") as f:
+        return upload_file_to_gemini(f)
+
+
+def upload_file_to_gemini(f):
+    """
+    Uploads an mp4 file object to the Gemini file store.
+    Returns the uploaded Gemini file.
+    """
+    logger.info("Uploading video to Gemini...")
+    f.seek(0)
+    video_file = get_genai_client().files.upload(
+        file=f,
+        config=types.UploadFileConfig(mime_type="video/mp4"),
+    )
+    logger.info(f"Uploaded file: {video_file.name}, state: {video_file.state.name}")
+    return video_file
+
+
+def transcode_for_gemini(source):
+    """
+    Transcodes the opened PyAV source container to a small h264 mp4 (at most
+    TRANSCODE_MAX_HEIGHT lines at TRANSCODE_FPS) for upload to Gemini.
+    Audio is dropped since detection relies on the hand gesture.
+    Returns the transcoded video as a spooled temp file.
+    """
+    source.seek(0)
+    output = tempfile.SpooledTemporaryFile(max_size=VIDEO_SPOOL_MAX_SIZE)
+    try:
+        with av.open(output, mode="w", format="mp4") as target:
+            in_stream = source.streams.video[0]
+            
+            width, height = in_stream.codec_context.width, in_stream.codec_context.height
+            if height > TRANSCODE_MAX_HEIGHT:
+                width = round(width * TRANSCODE_MAX_HEIGHT / height / 2) * 2
+                height = TRANSCODE_MAX_HEIGHT
+            
+            out_stream = target.add_stream("h264", rate=TRANSCODE_FPS)
+            out_stream.width = width
+            out_stream.height = height
+            out_stream.pix_fmt = "yuv420p"
+            out_stream.options = {"crf": "28", "preset": "veryfast"}
+            
+            frame_index = 0
+            for frame in source.decode(in_stream):
+                if frame.pts is None:
+                    continue
+                # Keep only frames that reach the next output timestamp
+                if frame.pts * in_stream.time_base < frame_index / TRANSCODE_FPS:
+                    continue
+                out_frame = frame.reformat(width=width, height=height, format="yuv420p")
+                out_frame.pts = frame_index
+                out_frame.time_base = Fraction(1, TRANSCODE_FPS)
+                frame_index += 1
+                for packet in out_stream.encode(out_frame):
+                    target.mux(packet)
+            
+            for packet in out_stream.encode():
+                target.mux(packet)
+        
+        if frame_index == 0:
+            raise ValueError("no frames were decoded from the source video")
+    except Exception:
+        output.close()
+        raise
+    
+    logger.info(
+        f"Transcoded video for Gemini: {frame_index} frames at {width}x{height}, "
+        f"{output.seek(0, os.SEEK_END)} bytes"
+    )
+    output.seek(0)
+    return output
+
+
+async def upload_transcoded_video(container, video):
+    """
+    Transcodes the downloaded video (opened as container) and uploads the
+    smaller copy to Gemini, falling back to uploading the original video
+    file object if it could not be opened or transcoded.
+    Returns the uploaded Gemini file.
+    """
+    try:
+        if container is None:
+            raise ValueError("video could not be opened")
+        transcoded = await asyncio.to_thread(transcode_for_gemini, container)
+    except Exception as e:
+        logger.warning(f"Transcoding failed, uploading the original video: {str(e)}")
+        return await call_gemini(upload_file_to_gemini, video)
+    
+    with transcoded:
+        return await call_gemini(upload_file_to_gemini, transcoded)
+
+
+def delete_gemini_file(video_file):
+    """Deletes an uploaded file from the Gemini file store."""
+    try:
+        get_genai_client().files.delete(name=video_file.name)
+        logger.info("Cleaned up uploaded video file from Gemini")
+    except Exception as e:
+        logger.warning(f"Could not delete uploaded file: {str(e)}")
+
+
+class GeminiFileError(RuntimeError):
+    """Raised when an uploaded Gemini file never becomes usable."""
+
+
+async def wait_for_gemini_file_active(video_file):
+    """
+    Polls the Gemini file state with exponential backoff until it is ACTIVE.
+    Raises GeminiFileError if Gemini fails to process the file, and
+    TimeoutError if it is not ready within FILE_POLL_TIMEOUT seconds.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + FILE_POLL_TIMEOUT
+    delay = FILE_POLL_INITIAL_DELAY
+    state = video_file.state.name
+    while video_file.state.name != "ACTIVE":
+        if video_file.state.name == "FAILED":
+            raise GeminiFileError(f"Gemini failed to process file {video_file.name}")
+        if loop.time() + delay > deadline:
+            raise TimeoutError(
+                f"File {video_file.name} not ready after {FILE_POLL_TIMEOUT:.0f}s "
+                f"(state: {video_file.state.name})"
+            )
+        logger.debug("Waiting for file to be ready... Current state: %s", video_file.state.name)
+        await asyncio.sleep(delay)
+        delay = min(delay * FILE_POLL_BACKOFF, FILE_POLL_MAX_DELAY)
+        video_file = await call_gemini(get_genai_client().files.get, name=video_file.name)
+        if video_file.state.name != state:
+            logger.info(f"File {video_file.name} state changed: {state} -> {video_file.state.name}")
+            state = video_file.state.name
+    return video_file
 
 
-def detect_kid_saying_67_with_gemini(video_path: str):
+async def detect_kid_saying_67_with_gemini(blob, video):
     """
-    Uses Gemini API to detect when a kid saying "67" appears in the video.
-    Uploads video to Gemini and uses video analysis to find the timestamp.
+    Uses Gemini API to detect when a kid saying "67" appears in the video blob.
+    Short videos are sent as sampled frames; longer ones are either passed to
+    Gemini by GCS URI or uploaded to Gemini. Then extracts the frame from
+    a local copy downloaded to the spooled file video.
     Returns (True/False, target_second float, frame image) if kid saying "67" is found.
     """
+    genai_client = get_genai_client()
     if not genai_client:
         logger.error("Gemini client not initialized")
         return False, None, None
@@ -149,80 +572,362 @@ Return ONLY JSON: {"second": <float>}
 """
     
     video_file = None
+    video_downloaded = False
+    frame_parts = None
+    # The local copy is opened (and its header parsed) once, then shared by
+    # the duration probe, sampling, transcoding and frame extraction
+    container = None
     try:
-        logger.info("Uploading video to Gemini...")
-        video_file = genai_client.files.upload(file=video_path)
-        
-        logger.info(f"Uploaded file: {video_file.name}, state: {video_file.state.name}")
-        while video_file.state.name != "ACTIVE":
-            logger.info(f"Waiting for file to be ready... Current state: {video_file.state.name}")
-            time.sleep(2)
-            video_file = genai_client.files.get(name=video_file.name)
-        
-        logger.info("File is ready, analyzing video with Gemini...")
-        response = genai_client.models.generate_content(
-            model="gemini-2.0-flash",
-            contents=types.Content(
-                parts=[
+        # Transcoding needs the local copy before the upload, so download it up
+        # front. Otherwise probe the header from GCS: the video is either read
+        # by Gemini from GCS, or its download overlaps the streaming upload.
+        probe_from_gcs = GEMINI_USE_GCS_URI or not TRANSCODE_FOR_GEMINI
+        if not probe_from_gcs:
+            await asyncio.to_thread(download_blob, blob, video)
+            video_downloaded = True
+            logger.info(f"Downloaded video {blob.name}")
+            try:
+                container = await asyncio.to_thread(open_video_container, video)
+            except Exception as e:
+                logger.warning(f"Could not open video with PyAV: {str(e)}")
+        
+        try:
+            if container is not None:
+                duration = get_container_duration(container)
+            else:
+                # Only the header is fetched; the cached container is reused if a
+                # frame has to be extracted later
+                duration = await asyncio.to_thread(get_blob_duration, blob)
+        except Exception as e:
+            logger.warning(f"Could not probe video duration: {str(e)}")
+            duration = None
+        
+        if duration is not None and duration < SAMPLED_FRAMES_MAX_DURATION:
+            # Short clips are sent as a handful of sampled frames, which skips
+            # the video upload and ACTIVE polling and uses far fewer tokens
+            if not video_downloaded:
+                await asyncio.to_thread(download_blob, blob, video)
+                video_downloaded = True
+                logger.info(f"Downloaded video {blob.name}")
+            try:
+                if container is None:
+                    container = await asyncio.to_thread(open_video_container, video)
+                frame_parts = await asyncio.to_thread(sample_frames, container, SAMPLED_FRAMES_FPS)
+            except Exception as e:
+                logger.warning(f"Frame sampling failed, sending the whole video: {str(e)}")
+        
+        if not frame_parts:
+            if GEMINI_USE_GCS_URI:
+                # Long videos are only downloaded once a frame needs to be extracted
+                video_uri = f"gs://{blob.bucket.name}/{blob.name}"
+            elif TRANSCODE_FOR_GEMINI:
+                # The original is kept locally for frame extraction
+                video_file = await upload_transcoded_video(container, video)
+            elif video_downloaded:
+                video_file = await call_gemini(upload_file_to_gemini, video)
+            else:
+                video_file = await download_and_upload_video(blob, video)
+                video_downloaded = True
+        
+        try:
+            if frame_parts:
+                logger.info(f"Analyzing {len(frame_parts) // 2} sampled frames with Gemini...")
+                parts = [
+                    types.Part(text=f"The video is given as frames sampled at {SAMPLED_FRAMES_FPS} fps, each preceded by its timestamp."),
+                    *frame_parts,
+                    types.Part(text=prompt),
+                ]
+            else:
+                if video_file:
+                    video_file = await wait_for_gemini_file_active(video_file)
+                    video_uri = video_file.uri
+                    logger.info("File is ready, analyzing video with Gemini...")
+                else:
+                    logger.info(f"Analyzing {video_uri} with Gemini...")
+                parts = [
                     types.Part(
                         file_data=types.FileData(
-                            file_uri=video_file.uri,
+                            file_uri=video_uri,
                             mime_type="video/mp4",
                         )
                     ),
                     types.Part(text=prompt),
                 ]
-            ),
-        )
-        
-        if not hasattr(response, 'text') or not response.text:
-            logger.error("Response has no text content")
-            return False, None, None
-        
-        response_text = response.text.strip()
-        
-        try:
-            data = json.loads(response_text)
-        except json.JSONDecodeError:
-            start_idx = response_text.find('{')
-            end_idx = response_text.rfind('}') + 1
-            if start_idx >= 0 and end_idx > start_idx:
-                json_str = response_text[start_idx:end_idx]
-                data = json.loads(json_str)
-            else:
+            
+            response = await call_gemini(
+                genai_client.models.generate_content,
+                model="gemini-2.0-flash",
+                contents=types.Content(parts=parts),
+            )
+            
+            if not hasattr(response, 'text') or not response.text:
+                logger.error("Response has no text content")
+                return False, None, None
+            
+            response_text = response.text.strip()
+            
+            match = SECOND_JSON_RE.search(response_text)
+            if not match:
                 logger.error(f"Could not find JSON in response: {response_text}")
                 return False, None, None
+            data = orjson.loads(match.group(0))
+            
+            target_second = float(data["second"])
+            logger.info(f"Kid saying '67' detected at: {target_second} seconds")
+            
+            logger.info(f"Extracting frame at {target_second} seconds...")
+            frame = None
+            if not video_downloaded:
+                try:
+                    frame = await asyncio.to_thread(extract_frame_from_blob, blob, target_second)
+                except Exception as e:
+                    logger.warning(f"Ranged frame extraction failed, downloading full video: {str(e)}")
+            
+            if frame is None:
+                if not video_downloaded:
+                    await asyncio.to_thread(download_blob, blob, video)
+                    logger.info(f"Downloaded video {blob.name}")
+                try:
+                    if container is None:
+                        container = await asyncio.to_thread(open_video_container, video)
+                    frame = await asyncio.to_thread(extract_frame_at, container, target_second)
+                except Exception as e:
+                    logger.warning(f"PyAV frame extraction failed, falling back to OpenCV: {str(e)}")
+                    frame = await asyncio.to_thread(extract_frame_with_opencv, video, target_second)
+            
+            if frame is None:
+                logger.error(f"Could not read frame at {target_second} seconds")
+                return False, None, None
+            
+            if VERIFY_HANDS and not await asyncio.to_thread(frame_has_hands, frame):
+                logger.info(f"No hands found in frame at {target_second} seconds, ignoring detection")
+                return False, None, None
+            
+            return True, target_second, frame
         
-        target_second = float(data["second"])
-        logger.info(f"Kid saying '67' detected at: {target_second} seconds")
-        
-        logger.info(f"Extracting frame at {target_second} seconds...")
-        cap = cv2.VideoCapture(video_path)
+        except (TimeoutError, GeminiFileError):
+            # Surface these to handle_event as an error response (rather than
+            # "not detected") so Eventarc retries the event
+            raise
         
-        if not cap.isOpened():
-            logger.error(f"Could not open video file {video_path}")
+        except Exception as e:
+            if is_rate_limited(e):
+                # Retries are exhausted; let Eventarc redeliver the event later
+                raise
+            logger.error(f"Error in detect_kid_saying_67_with_gemini: {str(e)}", exc_info=True)
             return False, None, None
         
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        frame_number = int(target_second * fps)
-        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
-        ret, frame = cap.read()
-        cap.release()
+        finally:
+            if video_file:
+                delete_gemini_file(video_file)
+    
+    finally:
+        if container is not None:
+            container.close()
+
+
+def frame_has_hands(frame) -> bool:
+    """
+    Returns True if MediaPipe Hands finds at least one hand in the BGR frame.
+    """
+    detector = get_hands_detector()
+    rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    with hands_lock:
+        result = detector.process(rgb)
+    return bool(result.multi_hand_landmarks)
+
+
+def get_blob_duration(blob):
+    """
+    Returns the video duration in seconds, or None if it is unknown.
+    Only the container header is read, via the cached GCS-backed container.
+    """
+    container, _, lock = get_cached_blob_container(blob)
+    with lock:
+        return get_container_duration(container)
+
+
+def get_container_duration(container):
+    """Returns the duration in seconds of an opened PyAV container, or None if it is unknown."""
+    stream = container.streams.video[0]
+    if stream.duration is not None:
+        return float(stream.duration * stream.time_base)
+    if container.duration is not None:
+        return container.duration / av.time_base
+    return None
+
+
+def sample_frames(container, fps: float):
+    """
+    Samples frames from an opened PyAV container at the given rate.
+    Returns Gemini parts alternating a "t=<sec>s" text marker and the
+    downscaled JPEG-encoded frame.
+    """
+    container.seek(0)
+    stream = container.streams.video[0]
+    parts = []
+    next_second = 0.0
+    for frame in container.decode(stream):
+        if frame.pts is None:
+            continue
+        second = float(frame.pts * stream.time_base)
+        if second < next_second:
+            continue
+        next_second = (int(second * fps) + 1) / fps
         
-        if ret:
-            return True, target_second, frame
+        if frame.width > SAMPLED_FRAME_MAX_WIDTH:
+            height = round(frame.height * SAMPLED_FRAME_MAX_WIDTH / frame.width / 2) * 2
+            frame = frame.reformat(width=SAMPLED_FRAME_MAX_WIDTH, height=height)
+        success, buf = cv2.imencode(
+            ".jpg",
+            frame.to_ndarray(format="bgr24"),
+            [cv2.IMWRITE_JPEG_QUALITY, SAMPLED_FRAME_JPEG_QUALITY],
+        )
+        if not success:
+            continue
+        parts.append(types.Part(text=f"t={second:.1f}s"))
+        parts.append(types.Part(inline_data=types.Blob(mime_type="image/jpeg", data=buf.tobytes())))
+    return parts
+
+
+def open_video_container(source):
+    """Opens a PyAV container for reading from a file path or seekable file object."""
+    # mode must be explicit: PyAV otherwise infers it from file.mode, which is
+    # "w+b" for a SpooledTemporaryFile that has not rolled over to disk
+    container = av.open(source, mode="r")
+    container.streams.video[0].thread_type = "AUTO"
+    return container
+
+
+def get_cached_blob_container(blob):
+    """
+    Returns a (container, reader, lock) entry for the blob, reusing an open
+    container when the same object generation was seen recently.
+    """
+    if blob.generation is None:
+        blob.reload()
+    key = (blob.bucket.name, blob.name, blob.generation)
+    
+    with container_cache_lock:
+        entry = container_cache.get(key)
+        if entry is not None:
+            container_cache.move_to_end(key)
+            return entry
+    
+    reader = blob.open("rb", chunk_size=RANGE_READ_CHUNK_SIZE)
+    try:
+        container = open_video_container(reader)
+    except Exception:
+        reader.close()
+        raise
+    entry = (container, reader, threading.Lock())
+    
+    evicted = []
+    with container_cache_lock:
+        if key in container_cache:
+            # Another request opened the same video concurrently
+            evicted.append(entry)
+            entry = container_cache[key]
         else:
-            logger.error(f"Could not read frame at {target_second} seconds")
-            return False, None, None
-            
-    except Exception as e:
-        logger.error(f"Error in detect_kid_saying_67_with_gemini: {str(e)}", exc_info=True)
-        return False, None, None
+            container_cache[key] = entry
+            while len(container_cache) > CONTAINER_CACHE_SIZE:
+                evicted.append(container_cache.popitem(last=False)[1])
+    
+    for container, reader, lock in evicted:
+        with lock:
+            container.close()
+            reader.close()
+    return entry
+
+
+def evict_cached_blob_container(blob):
+    """Closes and drops the cached container for the blob, if any."""
+    key = (blob.bucket.name, blob.name, blob.generation)
+    with container_cache_lock:
+        entry = container_cache.pop(key, None)
+    if entry is not None:
+        container, reader, lock = entry
+        with lock:
+            container.close()
+            reader.close()
+
+
+def extract_frame_from_blob(blob, target_second: float):
+    """
+    Extracts the frame at target_second without downloading the whole video.
+    PyAV demuxes from a seekable GCS reader, so only the container index and
+    the bytes around the keyframe before the target are fetched via ranged GETs.
+    Returns the frame as a BGR numpy array, or None if no frame was decoded.
+    """
+    container, _, lock = get_cached_blob_container(blob)
+    try:
+        with lock:
+            return extract_frame_at(container, target_second)
+    except Exception:
+        evict_cached_blob_container(blob)
+        raise
+
+
+def extract_frame_at(container, target_second: float):
+    """
+    Extracts the frame at target_second from an already opened PyAV container.
+    Seeks to the nearest keyframe before the target and decodes forward,
+    which is faster than OpenCV's frame seek and accurate for VFR videos.
+    Returns the frame as a BGR numpy array, or None if no frame was decoded.
+    """
+    stream = container.streams.video[0]
+    pts = int(target_second / stream.time_base)
+    container.seek(pts, stream=stream, any_frame=False, backward=True)
+    
+    for frame in container.decode(stream):
+        if frame.pts is not None and frame.pts * stream.time_base >= target_second:
+            return frame.to_ndarray(format="bgr24")
     
+    # The stream ended before target_second (e.g. a timestamp past the end)
+    return None
+
+
+def extract_frame_with_opencv(video, target_second: float):
+    """
+    Fallback frame extraction using OpenCV.
+    OpenCV can only open file paths, so the video file object is first
+    copied to a named temp file.
+    Returns the frame as a BGR numpy array, or None if it could not be read.
+    """
+    with tempfile.NamedTemporaryFile(suffix=".mp4") as tmp_video:
+        video.seek(0)
+        shutil.copyfileobj(video, tmp_video)
+        tmp_video.flush()
+        return read_frame_with_opencv(tmp_video.name, target_second)
+
+
+def read_frame_with_opencv(video_path: str, target_second: float):
+    """
+    Reads the frame at target_second from a video file with OpenCV.
+    Seeks by timestamp and grabs forward to the target frame.
+    Returns the frame as a BGR numpy array, or None if it could not be read.
+    """
+    cap = cv2.VideoCapture(video_path)
+    
+    if not cap.isOpened():
+        logger.error(f"Could not open video file {video_path}")
+        return None
+    
+    try:
+        target_ms = target_second * 1000
+        if target_ms > OPENCV_SEEK_LEAD_MS:
+            # Coarse seek to shortly before the target, then grab forward
+            cap.set(cv2.CAP_PROP_POS_MSEC, target_ms - OPENCV_SEEK_LEAD_MS)
+        
+        # grab() only demuxes/decodes without copying the frame out, and
+        # CAP_PROP_POS_MSEC stays accurate for VFR videos unlike frame indices
+        while True:
+            if not cap.grab():
+                return None
+            if cap.get(cv2.CAP_PROP_POS_MSEC) >= target_ms:
+                break
+        
+        ret, frame = cap.retrieve()
+        return frame if ret else None
     finally:
-        if video_file:
-            try:
-                genai_client.files.delete(name=video_file.name)
-                logger.info("Cleaned up uploaded video file from Gemini")
-            except Exception as e:
-                logger.warning(f"Could not delete uploaded file: {str(e)}")
+        cap.release()